@@ -5,144 +5,296 @@
 
 __author__ = 'zain'
 
+import argparse
+import atexit
+import heapq
 import sys
-import time
-from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from itertools import islice
 from os import path
-from threading import Lock
+from threading import Event, RLock, local
 from validate import Validator
 
+import orjson
 import requests
 from configobj import ConfigObj
-from retry import retry
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util import Retry
 
 from .stream_summary import StreamSummary
 
 SCRIPT_DIR = path.dirname(path.realpath(__file__))
 CONFIG_FILE = path.normpath(path.join(SCRIPT_DIR, '../config/config.ini'))
 CONFIG_SPEC_FILE = path.normpath(path.join(SCRIPT_DIR, '../config/configspec.ini'))
-MAIN_THREAD_SLEEP_INTERVAL = 50.0 / 1000.0
+CACHE_FILE = path.normpath(path.join(SCRIPT_DIR, '../.stats_cache'))
+MAIN_THREAD_WAIT_INTERVAL = 50.0 / 1000.0
+REQUEST_TIMEOUT = 30.0
+# failed requests are retried a set number of times, right away and then with an exponential backoff of 2, 4 & 8 seconds
+# only server side failures are retried, client side failures are not expected to succeed on a retry
+REQUEST_RETRY = Retry(total=4, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
 TOP_FOODS_TITLE = 'Top {} Foods\n' \
                   '============'
 TOP_FOOD_CATEGORIES_TITLE = 'Top {} Food Categories\n' \
                             '======================'
-quit_now = False  # pylint: disable=invalid-name
+# the parameters shared by all the workers of a run, the quit event signals them to stop further processing
+Job = namedtuple('Job', 'session endpoint limit quit_event')  # pylint: disable=invalid-name
+# the thread pool and the session are shared by all the runs, they are created on first use
+# and created anew whenever a run asks for different settings, as long as no other run is borrowing them
+# a single session is shared by all the workers, so that the underlying connections are kept alive across requests
+# the lock is reentrant, as borrowing takes it around the getters
+SHARED_LOCK = RLock()
+shared_executor = None  # pylint: disable=invalid-name
+shared_executor_settings = None  # pylint: disable=invalid-name
+shared_session = None  # pylint: disable=invalid-name
+shared_session_settings = None  # pylint: disable=invalid-name
+shared_borrowers = 0  # pylint: disable=invalid-name
 
 
 # pylint: disable=too-many-locals
 def run(top_foods_no, top_food_categories_no):
-    """Runner where the main logic of this programme starts."""
+    """Runner where the main logic of this programme starts.
+    Concurrent runs share the thread pool and the session, every run stops only its own windows on interrupt."""
     config = ConfigObj(CONFIG_FILE, configspec=CONFIG_SPEC_FILE)
     config.validate(Validator())
     # using 100 times the required top items as length of stream summaries, in order to accumulate better estimates
     top_foods = StreamSummary(top_foods_no * 100)
     top_food_categories = StreamSummary(top_food_categories_no * 100)
     max_threads = config['Multi-threading']['max_threads']
-    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+    # every worker thread aggregates into its own pair of stream summaries, so that no locking is needed among them
+    thread_summaries = []
+    summaries = ThreadSummaries(top_foods.size, top_food_categories.size, thread_summaries)
+    pending = set()
+    completed = False
+    with borrow_shared(max_threads, config['Cache']['expire_after']) as (executor, session):
+        # using maximum limit of the endpoint
+        # since, theoretically, large I/O per unit of work plays well with multi-threading
+        # although, the API seems to be serving requests with different limits in almost the same time
+        job = Job(session, config['API']['endpoint'], config['API']['max_limit'], Event())
         try:
-            endpoint = config['API']['endpoint']
-            global_min_offset = config['API']['min_offset']
-            global_max_offset = config['API']['max_offset']
-            # using maximum limit of the endpoint
-            # since, theoretically, large I/O per unit of work plays well with multi-threading
-            # although, the API seems to be serving requests with different limits in almost the same time
-            limit = config['API']['max_limit']
-            # distributing the data points equally among the threads
-            batch_size = int((global_max_offset - global_min_offset + 1) / max_threads)
-            if not batch_size:
-                batch_size = 1
-            lock = Lock()
-            global_offset_upper_bound = global_max_offset + 1
-            futures = []
-            for min_offset in range(global_min_offset, global_offset_upper_bound, batch_size):
-                offset_upper_bound = min_offset + batch_size
-                if offset_upper_bound > global_offset_upper_bound:
-                    offset_upper_bound = global_offset_upper_bound
-                futures.append(executor.submit(aggregate_stats, top_foods, top_food_categories, endpoint, min_offset,
-                                               offset_upper_bound, limit, lock))
-            # the thread pool executor handles keyboard interrupt gracefully
-            # as in, it blocks until all active workers finish their tasks
-            # in our case, we would rather exit immediately and display the stats aggregated up to that point
-            # so, we poll for completion of worker tasks with interleaved sleep to intercept keyboard interrupt
-            while any(not future.done() for future in futures):
-                time.sleep(MAIN_THREAD_SLEEP_INTERVAL)
+            windows = plan_windows(config['API']['min_offset'], config['API']['max_offset'], job.limit)
+            # every window is a task of its own, so that the thread pool balances the requests among the workers
+            # and a slow request holds up only itself
+            # the windows are submitted as the workers free up, rather than queueing futures for all of them up front
+            max_pending = 2 * max_threads
+            for window in windows:
+                while len(pending) >= max_pending:
+                    pending = wait_pending(pending)
+                pending.add(executor.submit(aggregate_stats, summaries, job, window))
+            while pending:
+                pending = wait_pending(pending)
+            completed = True
         except KeyboardInterrupt:
-            # we use a global variable to signal the workers to stop further processing
-            global quit_now  # pylint: disable=invalid-name, global-statement
-            quit_now = True
-    display_stats(top_foods, TOP_FOODS_TITLE, top_foods_no)
-    display_stats(top_food_categories, TOP_FOOD_CATEGORIES_TITLE, top_food_categories_no)
+            # the stats aggregated up to the point of interrupt are displayed below
+            pass
+        finally:
+            if not completed:
+                # we use an event to signal the workers to stop further processing, on interrupt as well as on error
+                job.quit_event.set()
+                # and drop the windows which have not started yet, rather than having them start only to quit
+                # only the windows of this run are dropped, the thread pool is left to serve any other run
+                for future in pending:
+                    future.cancel()
+                # this waits for the active workers to finish their current requests
+                wait(pending)
+            # all the workers are done at this point, so their stream summaries can be merged safely
+            # the stats aggregated so far are displayed even if a worker failed, before its error is raised
+            for thread_top_foods, thread_top_food_categories in thread_summaries:
+                top_foods.merge(thread_top_foods)
+                top_food_categories.merge(thread_top_food_categories)
+            display_stats(top_foods, TOP_FOODS_TITLE, top_foods_no)
+            display_stats(top_food_categories, TOP_FOOD_CATEGORIES_TITLE, top_food_categories_no)
 # pylint: enable=too-many-locals
 
 
-# pylint: disable=too-many-arguments
-def aggregate_stats(top_foods, top_food_categories, endpoint, min_offset, offset_upper_bound, limit, lock):
-    """Invoke requests to the REST API and add the responses to the stream summaries."""
+def wait_pending(pending):
+    """Wait for the pending futures, up to a short interval, and return the ones still pending.
+    The error of any completed future is raised."""
+    # we would rather exit immediately on keyboard interrupt and display the stats aggregated up to that point
+    # so, we wait for completion of worker tasks with a timeout to intercept keyboard interrupt
+    # as an untimed wait can not be interrupted on every platform
+    done, pending = wait(pending, timeout=MAIN_THREAD_WAIT_INTERVAL, return_when=FIRST_COMPLETED)
+    for future in done:
+        future.result()
+    return pending
+
+
+@contextmanager
+def borrow_shared(max_workers, cache_expire_after):
+    """Lend the shared thread pool and HTTP session, sized to the given number of workers, for the block.
+    Neither is replaced nor shut down while borrowed, a run asking for different settings meanwhile gets them as is."""
+    global shared_borrowers  # pylint: disable=invalid-name, global-statement
+    with SHARED_LOCK:
+        resources = get_executor(max_workers), get_session(max_workers, cache_expire_after)
+        shared_borrowers += 1
+    try:
+        yield resources
+    finally:
+        with SHARED_LOCK:
+            shared_borrowers -= 1
+
+
+def get_executor(max_workers):
+    """Return the shared thread pool, creating it with the given number of workers on first use.
+    The thread pool is replaced, if it was created with a different number of workers and is not borrowed."""
+    global shared_executor, shared_executor_settings  # pylint: disable=invalid-name, global-statement
+    with SHARED_LOCK:
+        if shared_executor is not None and shared_executor_settings != max_workers and not shared_borrowers:
+            # any work left in the replaced thread pool is finished in the background
+            shared_executor.shutdown(wait=False)
+            shared_executor = None
+        if shared_executor is None:
+            shared_executor = ThreadPoolExecutor(max_workers=max_workers)
+            shared_executor_settings = max_workers
+        return shared_executor
+
+
+def get_session(pool_size, cache_expire_after):
+    """Return the shared HTTP session, creating it with the given pool size and caching on first use.
+    The session is replaced, if it was created with a different pool size or caching and is not borrowed."""
+    global shared_session, shared_session_settings  # pylint: disable=invalid-name, global-statement
+    settings = (pool_size, cache_expire_after)
+    with SHARED_LOCK:
+        if shared_session is not None and shared_session_settings != settings and not shared_borrowers:
+            shared_session.close()
+            shared_session = None
+        if shared_session is None:
+            shared_session = create_session(pool_size, cache_expire_after)
+            shared_session_settings = settings
+        return shared_session
+
+
+def shutdown():
+    """Shut down the shared thread pool and close the shared session, they are created anew on next use.
+    Nothing is shut down while they are borrowed."""
+    global shared_executor, shared_session  # pylint: disable=invalid-name, global-statement
+    with SHARED_LOCK:
+        if shared_borrowers:
+            return
+        if shared_executor is not None:
+            shared_executor.shutdown()
+            shared_executor = None
+        if shared_session is not None:
+            shared_session.close()
+            shared_session = None
+
+
+atexit.register(shutdown)
+
+
+def plan_windows(global_min_offset, global_max_offset, limit):
+    """Split the offsets into windows of the given limit and yield them as (offset, count) pairs.
+    The count is the number of offsets in the window, which is short of the limit only for the last window."""
+    # the full windows are yielded as is, and the last, partial window, if any, once after them
+    full_windows, tail = divmod(max(global_max_offset + 1 - global_min_offset, 0), limit)
+    tail_offset = global_min_offset + full_windows * limit
+    for offset in range(global_min_offset, tail_offset, limit):
+        yield offset, limit
+    if tail:
+        yield tail_offset, tail
+
+
+def create_session(pool_size, cache_expire_after):
+    """Create an HTTP session with a connection pool of the given size, caching responses on disk if requested."""
+    if cache_expire_after:
+        # successful responses are persisted, so that reruns over the same offsets skip the network
+        # stale responses are revalidated with the server, if it provided an ETag or Last-Modified header
+        new_session = CachedSession(CACHE_FILE, backend='sqlite', expire_after=cache_expire_after)
+    else:
+        new_session = requests.Session()
+    # sizing the connection pool to the thread pool, so that every worker can hold on to its own connection
+    # retrying within the adapter keeps the connection alive across retries
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=REQUEST_RETRY)
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    return new_session
+
+
+class ThreadSummaries(local):  # pylint: disable=too-few-public-methods
+    """Represents the (top foods, top food categories) stream summaries of a worker thread.
+    Every thread gets its own pair on first access, which is also added to the given list for merging later on."""
+
+    def __init__(self, top_foods_size, top_food_categories_size, thread_summaries):
+        super().__init__()
+        self.top_foods = StreamSummary(top_foods_size)
+        self.top_food_categories = StreamSummary(top_food_categories_size)
+        thread_summaries.append((self.top_foods, self.top_food_categories))
+
+
+def aggregate_stats(summaries, job, window):
+    """Invoke a request to the REST API for an (offset, count) window and add the response to the stream summaries."""
+    if job.quit_event.is_set():
+        return
     # we're making an optimistic assumption that the data for all IDs is present on the server
     # so, requesting data with an incremental offset equal to the endpoint limit will not introduce duplication
-    for offset in range(min_offset, offset_upper_bound, limit):
-        if quit_now:
-            break
-        if offset + limit > offset_upper_bound:
-            limit = offset_upper_bound - offset
-        try:
-            foods = furnish_request(endpoint, offset, limit)
-            with lock:
-                for food in foods:
-                    top_foods.add(food['food_id'])
-                    top_food_categories.add(food['food_category_id'])
-        except RequestError:
-            # this exception will only occur here if the retry logic gave up,
-            # in which case we skip the request deeming it impossible to succeed
-            pass
-# pylint: enable=too-many-arguments
+    offset, count = window
+    try:
+        # every window is requested with the same limit, so that all requests share a canonical, cacheable form
+        foods = furnish_request(job.session, job.endpoint, offset, job.limit)
+    except RequestError:
+        # this exception will only occur here if the retry logic gave up,
+        # in which case we skip the request deeming it impossible to succeed
+        return
+    try:
+        if count < job.limit:
+            # the last window may be over-fetched, the items beyond the maximum offset are dropped
+            foods = foods[:count]
+        food_ids = [food['food_id'] for food in foods]
+        food_category_ids = [food['food_category_id'] for food in foods]
+    except (KeyError, TypeError):
+        # these exceptions are expected in case of malformed items in the response
+        # in which case we skip the window, rather than adding only a part of it
+        return
+    # the summaries are fed a batch per response, rather than an item at a time
+    summaries.top_foods.add_many(food_ids)
+    summaries.top_food_categories.add_many(food_category_ids)
 
 
 class RequestError(Exception):
     """Represents an unsuccessful request."""
-    pass
 
 
-@retry(RequestError, tries=5, delay=1, backoff=2)
-def furnish_request(endpoint, offset, limit):
-    """Furnish requests to the REST API and return the response.
-    This function will be retried a set number of times with an exponential backoff, in case of failed requests."""
-    res = requests.get(endpoint, params={'offset': offset, 'limit': limit})
+def furnish_request(session, endpoint, offset, limit):
+    """Furnish requests to the REST API over the given session and return the response.
+    The session retries failed requests, RequestError is raised once it gives up."""
+    try:
+        res = session.get(endpoint, params={'offset': offset, 'limit': limit}, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as exc:
+        # connection errors, timeouts and exhausted retries are all treated as unsuccessful requests
+        raise RequestError('Failed request to: {} with offset: {} and limit: {}'.format(endpoint, offset, limit)) \
+            from exc
     foods = []
     if res.status_code == 200:
         try:
-            res_body = res.json()
-            if res_body['response']:
+            # only a couple of fields per item are of interest, so the faster orjson decoder is preferred here
+            res_body = orjson.loads(res.content)
+            # anything but an array of items is treated as a malformed response
+            if isinstance(res_body['response'], list):
                 foods = res_body['response']
-        except (ValueError, TypeError):
-            # these exceptions are expected in case of non-JSON response
+        except (ValueError, TypeError, KeyError):  # orjson.JSONDecodeError is a subclass of ValueError
+            # these exceptions are expected in case of non-JSON or malformed response
             # as the request itself was successful, we will skip the response
             pass
     else:
-        # we raise an exception if the request is not successful, in order to retry it
+        # we raise an exception if the request is not successful
         raise RequestError('Unsuccessful request to: {} with offset: {} and limit: {}'.format(endpoint, offset, limit))
     return foods
 
 
 def display_stats(stream_summary, display_title, no_of_topk):
     """Display the stats for top items."""
-    print(display_title.format(no_of_topk))
-    frequencies = list(stream_summary.bucket_map.keys())
-    frequencies.reverse()
-    topk_iter = iter(range(1, no_of_topk + 1))
-    for frequency, serial_no in zip(frequencies, topk_iter):
-        items_iter = iter(stream_summary.bucket_map[frequency].items)
-        item = next(items_iter)
-        while True:
-            print('{}) Item(s) {} occur(s) {} times.'.format(serial_no, item, frequency))
-            try:
-                item = next(items_iter)
-                serial_no = next(topk_iter)
-            # break iteration on either of the following:
-            # a) items with the same frequency exhausted, we move on to items with other frequencies
-            # b) the requested number of top items displayed, we skip stats for any further items
-            except StopIteration:
-                break
+    bucket_map = stream_summary.bucket_map
+    # buckets are not kept in order of frequency, so we pick the top ones
+    # every bucket holds at least one item, so the top items always lie within the top no_of_topk buckets
+    frequencies = heapq.nlargest(no_of_topk, bucket_map)
+    # items with the same frequency are listed together, up to the requested number of top items
+    topk = islice(((frequency, item) for frequency in frequencies for item in bucket_map[frequency].items), no_of_topk)
+    lines = [display_title.format(no_of_topk)]
+    line_format = '{}) Item(s) {} occur(s) {} times.'.format
+    lines.extend(line_format(serial_no, item, frequency) for serial_no, (frequency, item) in enumerate(topk, 1))
+    print('\n'.join(lines))
 
 
 def main(argv):
@@ -153,8 +305,6 @@ def main(argv):
 
 def arg_parse(argv):
     """Parse arguments and return an args object."""
-    import argparse
-
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--top_foods', help='Number of top foods to aggregate stats for.', type=int, default=100)
     parser.add_argument('--top_food_categories', help='Number of top food categories to aggregate stats for.', type=int,
@@ -33,39 +33,45 @@ Copyright (C) 2012-2015  Bryant Moscon - bmoscon@gmail.com
  THE SOFTWARE.
 """
 
+from collections import OrderedDict
+
 
 # pylint: disable=invalid-name, missing-docstring
-class Bucket(object):
+class Bucket:
     """
-    A bucket is a list of objects with the same value
+    A bucket is an insertion ordered set of objects with the same value
     """
 
+    __slots__ = ('val', 'items')
+
     def __init__(self, v):
         self.val = v
-        self.items = []
+        # an ordered dict keeps the insertion order, while removing
+        # any item in constant time rather than scanning a list
+        self.items = OrderedDict()
 
     def __str__(self):
         s = "Bucket " + str(self.val) + "\n"
-        s += str(self.items)
+        s += str(list(self.items))
         return s
 
     def insert(self, e):
-        self.items.append(e)
+        self.items[e] = None
 
     def oldest(self):
-        return self.items[0]
+        return next(iter(self.items))
 
     def size(self):
         return len(self.items)
 
     def remove(self, e):
-        self.items.remove(e)
+        del self.items[e]
 
     def value(self):
         return self.val
 
 
-class StreamSummary(object):
+class StreamSummary:
     """
     Summarizes a Stream into the top N-1 number of objects (where N == SIZE). The last object
     in the StreamSummary (i.e. the Nth object) should be ignored.
@@ -82,8 +88,8 @@ class StreamSummary(object):
 
     def __str__(self):
         s = ''
-        for key in self.bucket_map.keys():
-            s += str(self.bucket_map[key])
+        for bucket in self.bucket_map.values():
+            s += str(bucket)
             s += '\n'
         return s
 
@@ -94,21 +100,23 @@ class StreamSummary(object):
         """
         # get value of item, and remove the item from that bucket.
         # if bucket is empty, remove it
+        bucket_map = self.bucket_map
         b = self.item_map[item]
-        val = b.value()
-        b.remove(item)
+        val = b.val
+        items = b.items
+        del items[item]
 
-        if b.size() == 0:
-            del self.bucket_map[val]
+        if not items:
+            del bucket_map[val]
             if self.min_val == val:
                 self.min_val += 1
 
         # find bucket+1. Create if needed. Insert item in bucket
-        if val + 1 in self.bucket_map:
-            b = self.bucket_map[val + 1]
-        else:
-            b = Bucket(val + 1)
-            self.bucket_map[val + 1] = b
+        val += 1
+        b = bucket_map.get(val)
+        if b is None:
+            b = Bucket(val)
+            bucket_map[val] = b
 
         b.insert(item)
         self.item_map[item] = b
@@ -151,6 +159,45 @@ class StreamSummary(object):
         b.insert(item)
         self.item_map[item] = b
 
+    def __add_count(self, item, count):
+        """
+        adds count to the value of an item. if the item is new and
+        there is no room for it, eject lowest ranked item and insert
+        new item with ejected_value+count
+        """
+        if item in self.item_map:
+            b = self.item_map[item]
+            val = b.value()
+            b.remove(item)
+            del self.item_map[item]
+        elif len(self.item_map) < self.size:
+            b = None
+            val = 0
+        else:
+            b = self.bucket_map[self.min_val]
+            old = b.oldest()
+            val = self.min_val
+            b.remove(old)
+            del self.item_map[old]
+
+        # if bucket is empty, remove it and find the new minimum
+        if b is not None and b.size() == 0:
+            del self.bucket_map[val]
+            if self.min_val == val:
+                self.min_val = min(self.bucket_map, default=0)
+
+        new_val = val + count
+        if new_val in self.bucket_map:
+            b = self.bucket_map[new_val]
+        else:
+            b = Bucket(new_val)
+            self.bucket_map[new_val] = b
+
+        b.insert(item)
+        self.item_map[item] = b
+        if self.min_val == 0 or new_val < self.min_val:
+            self.min_val = new_val
+
     def add(self, item):
         """
         adds an item to the summarized stream
@@ -162,6 +209,36 @@ class StreamSummary(object):
         else:
             self.__eject_and_insert(item)
 
+    def add_many(self, items):
+        """
+        adds a batch of items to the summarized stream
+        """
+        # bind the lookups to locals once for the whole batch
+        item_map = self.item_map
+        size = self.size
+        increment = self.__increment
+        insert = self.__insert
+        eject_and_insert = self.__eject_and_insert
+        for item in items:
+            if item in item_map:
+                increment(item)
+            elif len(item_map) < size:
+                insert(item)
+            else:
+                eject_and_insert(item)
+
+    def merge(self, other):
+        """
+        merges another stream summary into this one. items are added
+        in ascending order of their values, so that the highest ranked
+        items are the last ones to be ejected
+        """
+        add_count = self.__add_count
+        other_bucket_map = other.bucket_map
+        for val in sorted(other_bucket_map):
+            for item in other_bucket_map[val].items:
+                add_count(item, val)
+
     def exists(self, item):
         return item in self.item_map
 
@@ -171,5 +248,5 @@ class StreamSummary(object):
         self.min_val = 0
 
     def to_list(self):
-        return [item for item in self.item_map]
+        return list(self.item_map)
 # pylint: enable=invalid-name, missing-docstring
@@ -5,24 +5,73 @@
 
 __author__ = 'zain'
 
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import StringIO
+from os import path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread, current_thread
+from time import sleep
 import unittest
-from threading import Lock
 from unittest.mock import patch
 
+import requests
 from httmock import all_requests, response, urlmatch, HTTMock
+from requests_cache import CachedSession
 
 from stats import stats
 from stats.stream_summary import Bucket, StreamSummary
 
 
+@contextmanager
+def local_api(status_codes):
+    """Serve a local REST API responding with the given status codes in turn, the last one being repeated.
+    Yield the URL of the API and the list of paths requested from it."""
+    requested_paths = []
+
+    class Handler(BaseHTTPRequestHandler):  # pylint: disable=missing-docstring
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):  # pylint: disable=invalid-name, missing-docstring
+            requested_paths.append(self.path)
+            status_code = status_codes[min(len(requested_paths), len(status_codes)) - 1]
+            body = b'{"response": [{"food_id": 1, "food_category_id": 10}]}'
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(server.server_port), requested_paths
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_config(config_file, endpoint, max_offset, max_threads):
+    """Write a config for a run over the given endpoint and offsets, with the given number of threads."""
+    with open(config_file, 'w', encoding='utf8') as config:
+        config.write('[API]\nendpoint = {}\nmin_offset = 0\nmax_offset = {}\nmin_limit = 1\nmax_limit = 10\n'
+                     '[Multi-threading]\nmax_threads = {}\n[Cache]\nexpire_after = 0\n'
+                     .format(endpoint, max_offset, max_threads))
+
+
 class TestStats(unittest.TestCase):
     """Test Stats functions."""
 
     def test_aggregate_stats(self):
         """Test aggregate_stats function."""
         # successful requests should result in items being added to the stream summaries
-        def mock_furnish_request(endpoint, offset, limit):  # pylint: disable=missing-docstring, unused-argument
+        # pylint: disable=missing-docstring, unused-argument
+        def mock_furnish_request(session, endpoint, offset, limit):
             return [
                 {
                     'food_id': 1,
@@ -37,41 +86,244 @@ class TestStats(unittest.TestCase):
                     'food_category_id': 20,
                 }
             ]
-        top_foods = StreamSummary(10)
-        top_food_categories = StreamSummary(10)
-        endpoint = ''
-        min_offset = 100
-        offset_upper_bound = 250
-        limit = 100
-        lock = Lock()
+        summaries = stats.ThreadSummaries(10, 10, [])
+        top_foods = summaries.top_foods
+        top_food_categories = summaries.top_food_categories
+        job = stats.Job(None, '', 3, Event())
+        with patch('stats.stats.furnish_request', new=mock_furnish_request):
+            stats.aggregate_stats(summaries, job, (100, 3))
+            stats.aggregate_stats(summaries, job, (103, 3))
+            self.assertEqual(sorted(top_foods.bucket_map.keys()), [2, 4])
+            self.assertEqual(list(top_foods.bucket_map[2].items), [1])
+            self.assertEqual(list(top_foods.bucket_map[4].items), [2])
+            self.assertEqual(sorted(top_food_categories.bucket_map.keys()), [2, 4])
+            self.assertEqual(list(top_food_categories.bucket_map[2].items), [20])
+            self.assertEqual(list(top_food_categories.bucket_map[4].items), [10])
+
+        # items beyond the count of a short window should not be added to the stream summaries
+        summaries = stats.ThreadSummaries(10, 10, [])
         with patch('stats.stats.furnish_request', new=mock_furnish_request):
-            stats.aggregate_stats(top_foods, top_food_categories, endpoint, min_offset, offset_upper_bound, limit, lock)
-            self.assertEqual(tuple(top_foods.bucket_map.keys()), (2, 4))
-            self.assertEqual(top_foods.bucket_map[2].items, [1])
-            self.assertEqual(top_foods.bucket_map[4].items, [2])
-            self.assertEqual(tuple(top_food_categories.bucket_map.keys()), (2, 4))
-            self.assertEqual(top_food_categories.bucket_map[2].items, [20])
-            self.assertEqual(top_food_categories.bucket_map[4].items, [10])
+            stats.aggregate_stats(summaries, job, (100, 2))
+            self.assertEqual(sorted(summaries.top_foods.bucket_map.keys()), [1])
+            self.assertEqual(sorted(summaries.top_foods.bucket_map[1].items), [1, 2])
+            self.assertEqual(sorted(summaries.top_food_categories.bucket_map.keys()), [2])
+            self.assertEqual(list(summaries.top_food_categories.bucket_map[2].items), [10])
+
+        # responses with malformed items should result in no items being added to the stream summaries
+        def mock_malformed_furnish_request(session, endpoint, offset, limit):
+            return [{'food_id': 1, 'food_category_id': 10}, {'food_id': 2}, 'abc']
+        summaries = stats.ThreadSummaries(10, 10, [])
+        with patch('stats.stats.furnish_request', new=mock_malformed_furnish_request):
+            stats.aggregate_stats(summaries, job, (100, 3))
+            self.assertEqual(tuple(summaries.top_foods.bucket_map.keys()), ())
+            self.assertEqual(tuple(summaries.top_food_categories.bucket_map.keys()), ())
+
+        # responses other than an array of items should result in no items being added, the last window included
+        def mock_non_list_furnish_request(session, endpoint, offset, limit):
+            return {'food_id': 1, 'food_category_id': 10}
+        summaries = stats.ThreadSummaries(10, 10, [])
+        with patch('stats.stats.furnish_request', new=mock_non_list_furnish_request):
+            stats.aggregate_stats(summaries, job, (100, 3))
+            stats.aggregate_stats(summaries, job, (103, 2))
+            self.assertEqual(tuple(summaries.top_foods.bucket_map.keys()), ())
+            self.assertEqual(tuple(summaries.top_food_categories.bucket_map.keys()), ())
 
         # failed requests should result in no items being added to the stream summaries
-        def mock_failed_furnish_request(endpoint, offset, limit):  # pylint: disable=missing-docstring, unused-argument
+        # pylint: disable=missing-docstring, unused-argument
+        def mock_failed_furnish_request(session, endpoint, offset, limit):
             raise stats.RequestError
-        top_foods = StreamSummary(10)
-        top_food_categories = StreamSummary(10)
-        endpoint = ''
-        min_offset = 123
-        offset_upper_bound = 456
-        limit = 100
-        lock = Lock()
+        summaries = stats.ThreadSummaries(10, 10, [])
+        top_foods = summaries.top_foods
+        top_food_categories = summaries.top_food_categories
+        job = stats.Job(None, '', 100, Event())
         with patch('stats.stats.furnish_request', side_effect=mock_failed_furnish_request):
-            stats.aggregate_stats(top_foods, top_food_categories, endpoint, min_offset, offset_upper_bound, limit, lock)
+            stats.aggregate_stats(summaries, job, (123, 100))
             self.assertEqual(tuple(top_foods.bucket_map.keys()), ())
             self.assertEqual(tuple(top_food_categories.bucket_map.keys()), ())
 
+
+        # a run being stopped should result in no further requests
+        job.quit_event.set()
+        with patch('stats.stats.furnish_request', side_effect=mock_failed_furnish_request) as mock_furnish:
+            stats.aggregate_stats(summaries, job, (123, 100))
+            mock_furnish.assert_not_called()
+
         print('\n✓ aggregate_stats() works as expected')
 
+    def test_run(self):
+        """Test run function."""
+        # the stats aggregated so far should be displayed even if a worker fails, before its error is raised
+        # pylint: disable=missing-docstring, unused-argument
+        def mock_furnish_request(session, endpoint, offset, limit):
+            if offset == 30:
+                raise RuntimeError('unexpected failure')
+            return [{'food_id': offset, 'food_category_id': 1}] * 2
+        with TemporaryDirectory() as config_dir:
+            config_file = path.join(config_dir, 'config.ini')
+            for max_offset in (29, 39):
+                write_config(config_file, 'http://lucky', max_offset, 1)
+                with patch('stats.stats.CONFIG_FILE', new=config_file), \
+                        patch('stats.stats.furnish_request', new=mock_furnish_request), \
+                        patch('sys.stdout', new=StringIO()) as mock_stdout:
+                    if max_offset < 30:
+                        stats.run(1, 1)
+                    else:
+                        with self.assertRaises(RuntimeError):
+                            stats.run(1, 1)
+                    # the shared thread pool should be returned, and left usable by the next run
+                    self.assertEqual(stats.shared_borrowers, 0)
+                    self.assertEqual(stats.get_executor(1).submit(int).result(), 0)
+                    self.assertIn('1) Item(s) 1 occur(s) 6 times.', mock_stdout.getvalue())
+        stats.shutdown()
+
+        # concurrent runs should share the thread pool, and a failing run should not stop the windows of another run
+        # pylint: disable=missing-docstring, unused-argument
+        def mock_concurrent_furnish_request(session, endpoint, offset, limit):
+            sleep(0.01)
+            if endpoint == 'http://failing':
+                if offset == 30:
+                    raise RuntimeError('unexpected failure')
+                return [{'food_id': 2, 'food_category_id': 2}]
+            return [{'food_id': 1, 'food_category_id': 1}]
+        real_config_obj = stats.ConfigObj
+        errors = {}
+
+        def mock_config_obj(config_file, configspec):
+            return real_config_obj(config_files[current_thread().name], configspec=configspec)
+
+        def run_in_thread():
+            try:
+                stats.run(1, 1)
+            except RuntimeError as ex:
+                errors[current_thread().name] = ex
+        with TemporaryDirectory() as config_dir:
+            config_files = {name: path.join(config_dir, name + '.ini') for name in ('lucky', 'failing')}
+            write_config(config_files['lucky'], 'http://lucky', 1999, 4)
+            write_config(config_files['failing'], 'http://failing', 39, 8)
+            with patch('stats.stats.ConfigObj', new=mock_config_obj), \
+                    patch('stats.stats.furnish_request', new=mock_concurrent_furnish_request), \
+                    patch('sys.stdout', new=StringIO()) as mock_stdout:
+                threads = [Thread(target=run_in_thread, name=name) for name in ('lucky', 'failing')]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(list(errors), ['failing'])
+            self.assertIn('1) Item(s) 1 occur(s) 200 times.', mock_stdout.getvalue())
+            self.assertEqual(stats.shared_borrowers, 0)
+        stats.shutdown()
+        print('\n✓ run() works as expected')
+
+    def test_wait_pending(self):
+        """Test wait_pending function."""
+        # futures still pending after the wait interval should be returned, and errors of completed ones raised
+        pending_future = Future()
+        done_future = Future()
+        done_future.set_result(None)
+        self.assertEqual(stats.wait_pending({pending_future, done_future}), {pending_future})
+        failed_future = Future()
+        failed_future.set_exception(RuntimeError('unexpected failure'))
+        with self.assertRaises(RuntimeError):
+            stats.wait_pending({pending_future, failed_future})
+        print('\n✓ wait_pending() works as expected')
+
+    def test_thread_summaries(self):
+        """Test ThreadSummaries class."""
+        # every thread should get its own pair of stream summaries, and every pair should be collected
+        thread_summaries = []
+        summaries = stats.ThreadSummaries(10, 20, thread_summaries)
+        other_thread_pairs = []
+        thread = Thread(target=lambda: other_thread_pairs.append((summaries.top_foods, summaries.top_food_categories)))
+        thread.start()
+        thread.join()
+        self.assertEqual(thread_summaries, [(summaries.top_foods, summaries.top_food_categories)] + other_thread_pairs)
+        self.assertIsNot(other_thread_pairs[0][0], summaries.top_foods)
+        self.assertEqual(other_thread_pairs[0][0].size, 10)
+        self.assertEqual(other_thread_pairs[0][1].size, 20)
+        print('\n✓ ThreadSummaries works as expected')
+
+    def test_plan_windows(self):
+        """Test plan_windows function."""
+        # offsets should be split into contiguous windows, with the last window shrunk to end at the maximum offset
+        self.assertEqual(list(stats.plan_windows(100, 349, 100)), [(100, 100), (200, 100), (300, 50)])
+        self.assertEqual(list(stats.plan_windows(100, 299, 100)), [(100, 100), (200, 100)])
+        self.assertEqual(list(stats.plan_windows(100, 100, 10)), [(100, 1)])
+        self.assertEqual(list(stats.plan_windows(100, 99, 10)), [])
+        print('\n✓ plan_windows() works as expected')
+
+    def test_create_session(self):
+        """Test create_session function."""
+        # sessions without caching should be plain sessions, with connection pools of the requested size
+        session = stats.create_session(7, 0)
+        self.assertNotIsInstance(session, CachedSession)
+        for prefix in ('http://', 'https://'):
+            adapter = session.get_adapter(prefix)
+            self.assertEqual(adapter._pool_connections, 7)  # pylint: disable=protected-access
+            self.assertEqual(adapter._pool_maxsize, 7)  # pylint: disable=protected-access
+            self.assertIs(adapter.max_retries, stats.REQUEST_RETRY)
+
+        # sessions with caching should be cached sessions, serving repeated requests from the cache
+        with TemporaryDirectory() as cache_dir:
+            with patch('stats.stats.CACHE_FILE', new=path.join(cache_dir, 'cache')):
+                session = stats.create_session(7, 60)
+                self.assertIsInstance(session, CachedSession)
+                self.assertTrue(path.isfile(path.join(cache_dir, 'cache.sqlite')))
+                for prefix in ('http://', 'https://'):
+                    adapter = session.get_adapter(prefix)
+                    self.assertEqual(adapter._pool_maxsize, 7)  # pylint: disable=protected-access
+                    self.assertIs(adapter.max_retries, stats.REQUEST_RETRY)
+                with local_api([200]) as (endpoint, requested_paths):
+                    self.assertEqual(stats.furnish_request(session, endpoint, 10, 10),
+                                     [{'food_id': 1, 'food_category_id': 10}])
+                    self.assertEqual(stats.furnish_request(session, endpoint, 10, 10),
+                                     [{'food_id': 1, 'food_category_id': 10}])
+                    self.assertEqual(len(requested_paths), 1)
+                    stats.furnish_request(session, endpoint, 20, 10)
+                    self.assertEqual(len(requested_paths), 2)
+                session.close()
+        print('\n✓ create_session() works as expected')
+
+    def test_get_executor_and_session(self):
+        """Test borrow_shared, get_executor, get_session and shutdown functions."""
+        # the thread pool and the session should be created once, and reused until shut down
+        executor = stats.get_executor(2)
+        session = stats.get_session(2, 0)
+        self.assertIs(stats.get_executor(2), executor)
+        self.assertIs(stats.get_session(2, 0), session)
+        stats.shutdown()
+        self.assertIsNot(stats.get_executor(2), executor)
+        self.assertIsNot(stats.get_session(2, 0), session)
+
+        # the thread pool and the session should be created anew when different settings are requested
+        executor = stats.get_executor(2)
+        session = stats.get_session(2, 0)
+        self.assertIsNot(stats.get_executor(3), executor)
+        self.assertEqual(stats.get_executor(3)._max_workers, 3)  # pylint: disable=protected-access
+        self.assertIsNot(stats.get_session(3, 0), session)
+        session = stats.get_session(3, 0)
+        with TemporaryDirectory() as cache_dir:
+            with patch('stats.stats.CACHE_FILE', new=path.join(cache_dir, 'cache')):
+                self.assertIsInstance(stats.get_session(3, 30), CachedSession)
+                stats.shutdown()
+
+        # the thread pool and the session should be neither replaced nor shut down while borrowed
+        with stats.borrow_shared(2, 0) as (executor, session):
+            with stats.borrow_shared(3, 0) as resources:
+                self.assertEqual(resources, (executor, session))
+            self.assertIs(stats.get_executor(3), executor)
+            self.assertIs(stats.get_session(3, 0), session)
+            stats.shutdown()
+            self.assertIs(stats.shared_executor, executor)
+            self.assertEqual(executor.submit(int).result(), 0)
+        self.assertEqual(stats.shared_borrowers, 0)
+        self.assertIsNot(stats.get_executor(3), executor)
+        stats.shutdown()
+        self.assertIsNone(stats.shared_executor)
+        print('\n✓ borrow_shared(), get_executor(), get_session() & shutdown() work as expected')
+
     def test_furnish_request(self):
         """Test furnish_request function."""
+        session = requests.Session()
         # 200 response with JSON content should result in 'response' array being returned
         @all_requests
         def json_response(url, request):  # pylint: disable=missing-docstring, unused-argument
@@ -79,7 +331,21 @@ class TestStats(unittest.TestCase):
             headers = {'content-type': 'application/json'}
             return response(200, content, headers)
         with HTTMock(json_response):
-            self.assertEqual(stats.furnish_request('http://lucky', 10, 10), ['abc', 123])
+            self.assertEqual(stats.furnish_request(session, 'http://lucky', 10, 10), ['abc', 123])
+
+        # 200 response with JSON content lacking 'response' should result in empty array being returned
+        @all_requests
+        def malformed_json_response(url, request):  # pylint: disable=missing-docstring, unused-argument
+            return response(200, {}, {'content-type': 'application/json'})
+        with HTTMock(malformed_json_response):
+            self.assertEqual(stats.furnish_request(session, 'http://lucky', 10, 10), [])
+
+        # 200 response with JSON content having a non-array 'response' should result in empty array being returned
+        @all_requests
+        def non_array_json_response(url, request):  # pylint: disable=missing-docstring, unused-argument
+            return response(200, {'response': {'food_id': 1}}, {'content-type': 'application/json'})
+        with HTTMock(non_array_json_response):
+            self.assertEqual(stats.furnish_request(session, 'http://lucky', 10, 10), [])
 
         # 200 response with non-JSON content should result in empty array being returned
         @urlmatch(netloc=r'(.*\.)?string')
@@ -96,16 +362,35 @@ class TestStats(unittest.TestCase):
                 'content': 123
             }
         with HTTMock(string_response, integer_response):
-            self.assertEqual(stats.furnish_request('http://string', 10, 10), [])
-            self.assertEqual(stats.furnish_request('http://integer', 10, 10), [])
+            self.assertEqual(stats.furnish_request(session, 'http://string', 10, 10), [])
+            self.assertEqual(stats.furnish_request(session, 'http://integer', 10, 10), [])
 
-        # persistent non-200 responses should result in RequestError being thrown
+        # non-200 responses should result in RequestError being thrown
         @all_requests
         def non_200_response(url, request):  # pylint: disable=missing-docstring, unused-argument
             return {'status_code': 503}
         with self.assertRaises(stats.RequestError):
             with HTTMock(non_200_response):
-                stats.furnish_request('http://bluh', 10, 10)
+                stats.furnish_request(session, 'http://bluh', 10, 10)
+
+        # the session should retry server side failures, and RequestError should be thrown once it gives up
+        # the retry policy is kept as is, bar the backoff
+        with patch('stats.stats.REQUEST_RETRY', new=stats.REQUEST_RETRY.new(backoff_factor=0)):
+            session = stats.create_session(1, 0)
+        with local_api([503, 503, 200]) as (endpoint, requested_paths):
+            self.assertEqual(stats.furnish_request(session, endpoint, 10, 10),
+                             [{'food_id': 1, 'food_category_id': 10}])
+            self.assertEqual(len(requested_paths), 3)
+        with local_api([503]) as (endpoint, requested_paths):
+            with self.assertRaises(stats.RequestError):
+                stats.furnish_request(session, endpoint, 10, 10)
+            self.assertEqual(len(requested_paths), 5)
+        # client side failures should not be retried
+        with local_api([404]) as (endpoint, requested_paths):
+            with self.assertRaises(stats.RequestError):
+                stats.furnish_request(session, endpoint, 10, 10)
+            self.assertEqual(len(requested_paths), 1)
+        session.close()
 
         print('\n✓ furnish_request() works as expected')
 
@@ -135,8 +420,43 @@ class TestStats(unittest.TestCase):
         with patch('sys.stdout', new=StringIO()) as mock_stdout:
             stats.display_stats(stream_summary, 'Top {} items', 5)
             self.assertEqual(mock_stdout.getvalue().strip(), expected_output)
+
+        # buckets should be arranged in descending order regardless of their order in the stream summary
+        stream_summary.bucket_map = {frequency: stream_summary.bucket_map[frequency] for frequency in (3, 5, 1, 4, 2)}
+        with patch('sys.stdout', new=StringIO()) as mock_stdout:
+            stats.display_stats(stream_summary, 'Top {} items', 5)
+            self.assertEqual(mock_stdout.getvalue().strip(), expected_output)
         print('\n✓ display_stats() works as expected')
 
+    def test_stream_summary_merge(self):
+        """Test StreamSummary.merge method."""
+        # counts of items present in both stream summaries should be added up
+        stream_summary = StreamSummary(10)
+        other_stream_summary = StreamSummary(10)
+        for item in [1, 1, 2]:
+            stream_summary.add(item)
+        for item in [1, 2, 2, 3]:
+            other_stream_summary.add(item)
+        stream_summary.merge(other_stream_summary)
+        self.assertEqual(sorted(stream_summary.bucket_map.keys()), [1, 3])
+        self.assertEqual(sorted(stream_summary.bucket_map[3].items), [1, 2])
+        self.assertEqual(list(stream_summary.bucket_map[1].items), [3])
+        self.assertEqual(stream_summary.min_val, 1)
+
+        # new items should eject the lowest ranked items once the stream summary is full
+        stream_summary = StreamSummary(2)
+        other_stream_summary = StreamSummary(2)
+        for item in [1, 1, 2]:
+            stream_summary.add(item)
+        for item in [3, 3, 3]:
+            other_stream_summary.add(item)
+        stream_summary.merge(other_stream_summary)
+        self.assertEqual(sorted(stream_summary.bucket_map.keys()), [2, 4])
+        self.assertEqual(list(stream_summary.bucket_map[2].items), [1])
+        self.assertEqual(list(stream_summary.bucket_map[4].items), [3])
+        self.assertEqual(stream_summary.min_val, 2)
+        print('\n✓ StreamSummary.merge() works as expected')
+
     def setUpClass(self=None):
         print('\n==============================================' +
               '\n|              Stats Unit Tests              |' +